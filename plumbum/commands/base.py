@@ -1,3 +1,4 @@
+import re
 import subprocess
 import functools
 from contextlib import contextmanager
@@ -18,6 +19,9 @@ class RedirectionError(Exception):
 # modified from the stdlib pipes module for windows
 _safechars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!@%_-+=:,./'
 _funnychars = '"`$\\'
+# a single C-level regex match replaces the per-character Python loop for the
+# common case of path-like arguments that need no quoting at all
+_safe_match = re.compile("[%s]+\\Z" % (re.escape(_safechars),)).match
 def shquote(text):
     """Quotes the given text with shell escaping (assumes as syntax similar to ``sh``)"""
     if not text:
@@ -25,10 +29,7 @@ def shquote(text):
     text = str(text)
     if not text:
         return "''"
-    for c in text:
-        if c not in _safechars:
-            break
-    else:
+    if _safe_match(text):
         return text
     if "'" not in text:
         return "'" + text + "'"
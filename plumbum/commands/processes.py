@@ -1,78 +1,201 @@
+import os
 import time
 import atexit
+import codecs
+import functools
 import heapq
+from collections import deque
 from subprocess import Popen
-from threading import Thread
+from threading import Thread, Lock, Event, Condition, local as _thread_local
 from plumbum.lib import IS_WIN32, six
 
-try:
-    from queue import Queue, Empty as QueueEmpty
-except ImportError:
-    from Queue import Queue, Empty as QueueEmpty
-
 try:
     from io import StringIO
 except ImportError:
     from cStringIO import StringIO
 
+if not IS_WIN32:
+    import fcntl
+
+# each thread reuses one selector for _iter_lines, re-registering the two pipes
+# per call; this saves the epoll_create/close syscall pair on every invocation
+_selector_tls = _thread_local()
+
 
 #===================================================================================================
 # utility functions
 #===================================================================================================
 def _check_process(proc, retcode, timeout, stdout, stderr):
+    # fetch the optional attributes once up front; each getattr miss walks the
+    # whole MRO of the Popen class, and this runs for every completed process
     machine = getattr(proc, "machine", None)
+    argv = getattr(proc, "argv", None)
     on_done = getattr(proc, "on_done", None)
     if on_done:
         on_done(proc=proc, retcode=retcode, timeout=timeout, stdout=stdout, stderr=stderr)
     if getattr(proc, "_timed_out", False):
         raise ProcessTimedOut("Process did not terminate within %s seconds" % (timeout,),
-            getattr(proc, "argv", None), machine)
+            argv, machine)
 
+    returncode = proc.returncode
     if retcode is not None:
         if hasattr(retcode, "__contains__"):
-            if proc.returncode not in retcode:
-                raise ProcessExecutionError(getattr(proc, "argv", None), proc.returncode,
-                    stdout, stderr, machine)
-        elif proc.returncode != retcode:
-            raise ProcessExecutionError(getattr(proc, "argv", None), proc.returncode,
-                stdout, stderr, machine)
-    return proc.returncode, stdout, stderr
+            if returncode not in retcode:
+                raise ProcessExecutionError(argv, returncode, stdout, stderr, machine)
+        elif returncode != retcode:
+            raise ProcessExecutionError(argv, returncode, stdout, stderr, machine)
+    return returncode, stdout, stderr
 
 def _iter_lines(proc, decode, linesize, line_timeout=None):
 
+    partials = [b"", b""]  # partial trailing lines held back by the selector
+
     try:
         from selectors import DefaultSelector, EVENT_READ
     except ImportError:
-        # Pre Python 3.4 implementation
-        from select import select
+        # Pre Python 3.4 implementation; poll() registers the fds once, instead of
+        # rebuilding (and rescanning) fd sets on every call the way select() does
+        import select
         def selector():
-            while True:
-                rlist, _, _ = select([proc.stdout, proc.stderr], [], [], line_timeout)
-                if not rlist and line_timeout:
+            # bind the readline methods once; a LOAD_FAST per line beats
+            # attribute lookups on the Popen object
+            streams = {proc.stdout.fileno(): (0, proc.stdout.readline), proc.stderr.fileno(): (1, proc.stderr.readline)}
+            poller = select.poll()
+            for fd in streams:
+                poller.register(fd, select.POLLIN)
+            while streams:
+                ready = poller.poll(line_timeout * 1000 if line_timeout else None)
+                if not ready and line_timeout:
                     raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
-                for stream in rlist:
-                    yield (stream is proc.stderr), decode(stream.readline(linesize))
+                for fd, _ in ready:
+                    tag, readline = streams[fd]
+                    line = readline(linesize)
+                    if not line:
+                        # EOF; stop watching this stream
+                        poller.unregister(fd)
+                        del streams[fd]
+                        continue
+                    yield tag, decode(line)
     else:
         # Python 3.4 implementation
         def selector():
-            sel = DefaultSelector()
-            sel.register(proc.stdout, EVENT_READ, 0)
-            sel.register(proc.stderr, EVENT_READ, 1)
-            while True:
-                ready = sel.select(line_timeout)
-                if not ready and line_timeout:
-                    raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
-                for key, mask in ready:
-                    yield key.data, decode(key.fileobj.readline(linesize))
-
+            # reuse the per-thread cached selector only when it is idle; a
+            # second iter_lines generator active in the same thread must not
+            # share it (it would drain the other process' fds), so it gets a
+            # private selector instead, closed when the generator ends
+            sel = getattr(_selector_tls, "sel", None)
+            if sel is None:
+                sel = _selector_tls.sel = DefaultSelector()
+            private = None
+            if sel.get_map():
+                sel = private = DefaultSelector()
+            if IS_WIN32:
+                # chunked os.read needs non-blocking pipes; keep one blocking
+                # readline per wakeup here
+                sel.register(proc.stdout, EVENT_READ, (0, proc.stdout.readline))
+                sel.register(proc.stderr, EVENT_READ, (1, proc.stderr.readline))
+                eof = [False, False]
+                try:
+                    while not (eof[0] and eof[1]):
+                        ready = sel.select(line_timeout)
+                        if not ready and line_timeout:
+                            raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
+                        for key, mask in ready:
+                            tag, readline = key.data
+                            line = readline(linesize)
+                            if not line:
+                                # EOF; stop watching this stream
+                                eof[tag] = True
+                                sel.unregister(key.fileobj)
+                                continue
+                            yield tag, decode(line)
+                    return
+                finally:
+                    # unregister only our own streams, leaving the selector
+                    # empty for the next call
+                    for stream in (proc.stdout, proc.stderr):
+                        try:
+                            sel.unregister(stream)
+                        except KeyError:
+                            pass
+                    if private is not None:
+                        private.close()
+            orig_flags = {}
+            for stream in (proc.stdout, proc.stderr):
+                fd = stream.fileno()
+                orig_flags[fd] = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, orig_flags[fd] | os.O_NONBLOCK)
+            sel.register(proc.stdout, EVENT_READ, (0, proc.stdout.fileno()))
+            sel.register(proc.stderr, EVENT_READ, (1, proc.stderr.fileno()))
+            eof = [False, False]
+            try:
+                while True:
+                    ready = sel.select(line_timeout)
+                    if not ready and line_timeout:
+                        raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
+                    for key, mask in ready:
+                        tag, fd = key.data
+                        try:
+                            # a single 64KB read amortizes the syscall over many
+                            # lines; splitting happens here instead of paying
+                            # readline's per-line locking and buffer logic
+                            data = os.read(fd, 65536)
+                        except (BlockingIOError, InterruptedError):
+                            continue
+                        if not data:
+                            # EOF; flush any partial trailing line and stop
+                            # watching this stream. The partial is cleared
+                            # before yielding: the caller may break out of the
+                            # loop while we're suspended at the yield, and the
+                            # tail drain would then see it again
+                            eof[tag] = True
+                            sel.unregister(key.fileobj)
+                            if partials[tag]:
+                                trailing, partials[tag] = partials[tag], b""
+                                yield tag, decode(trailing)
+                            continue
+                        lines = (partials[tag] + data).split(b"\n")
+                        partials[tag] = lines.pop()  # trailing partial line, if any
+                        for line in lines:
+                            if linesize > 0:
+                                while len(line) > linesize:
+                                    yield tag, decode(line[:linesize])
+                                    line = line[linesize:]
+                            yield tag, decode(line + b"\n")
+                    if eof[0] and eof[1]:
+                        return
+            finally:
+                # unregister only our own streams, leaving the selector empty
+                # for the next call, and put the pipes back the way we found
+                # them -- the caller may keep reading them (e.g. communicate
+                # after breaking out of iter_lines) and expects blocking reads
+                for stream in (proc.stdout, proc.stderr):
+                    try:
+                        sel.unregister(stream)
+                    except KeyError:
+                        pass
+                for fd, flags in orig_flags.items():
+                    try:
+                        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+                    except OSError:
+                        pass  # the pipe may already be closed
+                if private is not None:
+                    private.close()
+
+    # the OS closes the pipes when the process exits, so stream EOF doubles as
+    # exit detection; no proc.poll() syscall per yielded line is needed
     for ret in selector():
         yield ret
-        if proc.poll() is not None:
-            break
-    for line in proc.stdout:
-        yield 0, decode(line)
-    for line in proc.stderr:
-        yield 1, decode(line)
+    for tag, stream in ((0, proc.stdout), (1, proc.stderr)):
+        for line in stream:
+            if partials[tag]:
+                line = partials[tag] + line
+                partials[tag] = b""
+            yield tag, decode(line)
+        if partials[tag]:
+            yield tag, decode(partials[tag])
+            partials[tag] = b""
+    proc.wait()
 
 
 #===================================================================================================
@@ -99,15 +222,20 @@ class ProcessExecutionError(EnvironmentError):
         self.stdout = stdout
         self.stderr = stderr
         self.machine = machine
+        self._str = None
     def __str__(self):
-        stdout = "\n         | ".join(str(self.stdout).splitlines())
-        stderr = "\n         | ".join(str(self.stderr).splitlines())
-        lines = ["Command line: %r" % " ".join(self.argv), "Exit code: %s" % (self.retcode), "Machine: %s" % (self.machine,)]
-        if stdout:
-            lines.append("Stdout:  | %s" % (stdout,))
-        if stderr:
-            lines.append("Stderr:  | %s" % (stderr,))
-        return "\n".join(lines)
+        # loggers tend to call str(exc) repeatedly, so format lazily and cache;
+        # a single C-level replace also beats splitlines+join
+        if self._str is None:
+            stdout = str(self.stdout).rstrip("\n").replace("\n", "\n         | ")
+            stderr = str(self.stderr).rstrip("\n").replace("\n", "\n         | ")
+            lines = ["Command line: %r" % " ".join(self.argv), "Exit code: %s" % (self.retcode), "Machine: %s" % (self.machine,)]
+            if stdout:
+                lines.append("Stdout:  | %s" % (stdout,))
+            if stderr:
+                lines.append("Stderr:  | %s" % (stderr,))
+            self._str = "\n".join(lines)
+        return self._str
 
 class ProcessTimedOut(Exception):
     """Raises by :func:`run_proc <plumbum.commands.run_proc>` when a ``timeout`` has been
@@ -140,78 +268,230 @@ class CommandNotFound(AttributeError):
 #===================================================================================================
 # Timeout thread
 #===================================================================================================
-class MinHeap(object):
-    def __init__(self, items = ()):
-        self._items = list(items)
-        heapq.heapify(self._items)
-    def __len__(self):
-        return len(self._items)
-    def push(self, item):
-        heapq.heappush(self._items, item)
-    def pop(self):
-        heapq.heappop(self._items)
-    def peek(self):
-        return self._items[0]
-
-_timeout_queue = Queue()
+# registrations are handed to the timeout thread through a plain deque (append
+# and popleft are atomic at the C level) rather than a queue.Queue, whose
+# lock+condition pair we don't need -- the deadline heap is the source of truth
+_timeout_pending = deque()
 _shutting_down = False
-
-def _timeout_thread_func():
-    waiting = MinHeap()
-    try:
-        while not _shutting_down:
-            if waiting:
-                ttk, _ = waiting.peek()
-                timeout = max(0, ttk - time.time())
+_bgthd_done = Event()
+
+# deadlines are monotonic-clock based, so NTP steps or suspend/resume can't fire
+# (or postpone) timeouts spuriously; monotonic is also vDSO-backed on Linux
+_now = time.monotonic
+
+# don't wake more often than once per millisecond; deadlines within half of that
+# of "now" are drained together instead of each getting its own wake
+_MIN_TIMEOUT_GRANULARITY = 0.001
+_TIMEOUT_DRAIN_SLACK = _MIN_TIMEOUT_GRANULARITY / 2
+
+_HAS_TIMERFD = hasattr(os, "timerfd_create") and hasattr(os, "eventfd")
+
+if _HAS_TIMERFD:
+    # Linux implementation: a timerfd+epoll reactor. The kernel timer is armed once
+    # per change of the earliest deadline (instead of recomputing a wait timeout on
+    # every wake), and registrations wake the thread through an eventfd.
+    import select
+
+    _tfd = os.timerfd_create(time.CLOCK_MONOTONIC, flags = os.TFD_NONBLOCK)
+    _efd = os.eventfd(0, os.EFD_NONBLOCK)
+    _ep = select.epoll()
+    _ep.register(_tfd, select.EPOLLIN)
+    # the eventfd is edge-triggered so the thread doesn't have to drain its counter
+    # on every wakeup; producers only write it when no wakeup is already pending
+    _ep.register(_efd, select.EPOLLIN | select.EPOLLET)
+    _wakeup_lock = Lock()
+    _wakeup_pending = False
+    _head_deadline = None  # the deadline the timerfd is currently armed for
+
+    def _signal_timeout_thread():
+        global _wakeup_pending
+        with _wakeup_lock:
+            if _wakeup_pending:
+                return
+            _wakeup_pending = True
+        try:
+            os.eventfd_write(_efd, 1)
+        except BlockingIOError:
+            # counter saturated; drain it and retry
+            os.eventfd_read(_efd)
+            os.eventfd_write(_efd, 1)
+
+    def _timeout_thread_func():
+        global _wakeup_pending, _head_deadline
+        waiting = []  # min-heap of (deadline, proc), via heapq
+        armed_deadline = None
+        try:
+            while not _shutting_down:
+                for fd, _ in _ep.poll():
+                    if fd == _tfd:
+                        try:
+                            os.read(_tfd, 8)  # consume the expiration count
+                        except OSError:
+                            pass
+                with _wakeup_lock:
+                    _wakeup_pending = False
+                while True:
+                    try:
+                        proc, time_to_kill = _timeout_pending.popleft()
+                    except IndexError:
+                        break
+                    if proc is SystemExit:
+                        # terminate
+                        return
+                    heapq.heappush(waiting, (time_to_kill, proc))
+                now = _now()
+                while waiting and waiting[0][0] <= now + _TIMEOUT_DRAIN_SLACK:
+                    _, proc = heapq.heappop(waiting)
+                    try:
+                        if proc.poll() is None:
+                            proc.kill()
+                            proc._timed_out = True
+                    except EnvironmentError:
+                        pass
+                if waiting:
+                    head_deadline = waiting[0][0]
+                    if head_deadline != armed_deadline:
+                        os.timerfd_settime(_tfd, initial = max(head_deadline - _now(), _MIN_TIMEOUT_GRANULARITY))
+                        armed_deadline = head_deadline
+                else:
+                    head_deadline = None
+                with _wakeup_lock:
+                    _head_deadline = head_deadline
+                if _timeout_pending:
+                    # a registration slipped in after the drain; service it before
+                    # blocking, in case its producer skipped the wakeup
+                    continue
+        except Exception:
+            if _shutting_down:
+                # to prevent all sorts of exceptions during interpreter shutdown
+                pass
             else:
-                timeout = None
-            try:
-                proc, time_to_kill = _timeout_queue.get(timeout = timeout)
-                if proc is SystemExit:
-                    # terminate
-                    return
-                waiting.push((time_to_kill, proc))
-            except QueueEmpty:
+                raise
+        finally:
+            _bgthd_done.set()
+
+else:
+    # Generic implementation (Windows/macOS/older Pythons): wait on a condition
+    # variable with a timeout recomputed from the head of the deadline heap
+    _timeout_cond = Condition()
+
+    def _signal_timeout_thread():
+        with _timeout_cond:
+            _timeout_cond.notify()
+
+    def _timeout_thread_func():
+        waiting = []  # min-heap of (deadline, proc), via heapq
+        try:
+            while not _shutting_down:
+                with _timeout_cond:
+                    if not _timeout_pending:
+                        if waiting:
+                            _timeout_cond.wait(max(_MIN_TIMEOUT_GRANULARITY, waiting[0][0] - _now()))
+                        else:
+                            _timeout_cond.wait()
+                while True:
+                    try:
+                        proc, time_to_kill = _timeout_pending.popleft()
+                    except IndexError:
+                        break
+                    if proc is SystemExit:
+                        # terminate
+                        return
+                    heapq.heappush(waiting, (time_to_kill, proc))
+                now = _now()
+                while waiting and waiting[0][0] <= now + _TIMEOUT_DRAIN_SLACK:
+                    _, proc = heapq.heappop(waiting)
+                    try:
+                        if proc.poll() is None:
+                            proc.kill()
+                            proc._timed_out = True
+                    except EnvironmentError:
+                        pass
+        except Exception:
+            if _shutting_down:
+                # to prevent all sorts of exceptions during interpreter shutdown
                 pass
-            now = time.time()
-            while waiting:
-                ttk, proc = waiting.peek()
-                if ttk > now:
-                    break
-                waiting.pop()
-                try:
-                    if proc.poll() is None:
-                        proc.kill()
-                        proc._timed_out = True
-                except EnvironmentError:
-                    pass
-    except Exception:
-        if _shutting_down:
-            # to prevent all sorts of exceptions during interpreter shutdown
-            pass
-        else:
-            raise
+            else:
+                raise
+        finally:
+            _bgthd_done.set()
 
 bgthd = Thread(target = _timeout_thread_func, name = "PlumbumTimeoutThread")
-bgthd.setDaemon(True)
-bgthd.start()
+bgthd.daemon = True
+
+# the thread is only started on the first actual timeout registration; scripts
+# that never use timeouts don't pay for its creation (or keep an idle thread)
+_bgthd_started = False
+_bgthd_start_lock = Lock()
+
+def _start_bg_thread():
+    global _bgthd_started
+    if not _bgthd_started:
+        with _bgthd_start_lock:
+            if not _bgthd_started:
+                bgthd.start()
+                _bgthd_started = True
 
 def _register_proc_timeout(proc, timeout):
     if timeout is not None:
-        _timeout_queue.put((proc, time.time() + timeout))
+        _start_bg_thread()
+        deadline = _now() + timeout
+        _timeout_pending.append((proc, deadline))
+        if _HAS_TIMERFD:
+            with _wakeup_lock:
+                head = _head_deadline
+            if head is not None and deadline >= head:
+                # the thread will wake up before this deadline matters anyway
+                return
+        _signal_timeout_thread()
 
 def _shutdown_bg_threads():
     global _shutting_down
     _shutting_down = True
-    _timeout_queue.put((SystemExit, 0))
-    # grace period
-    bgthd.join(0.1)
+    if not _bgthd_started:
+        return
+    _timeout_pending.append((SystemExit, 0))
+    _signal_timeout_thread()
+    # grace period, skipped when the thread has already drained and exited
+    _bgthd_done.wait(0.1)
 
 atexit.register(_shutdown_bg_threads)
 
 #===================================================================================================
 # run_proc
 #===================================================================================================
+@functools.lru_cache(maxsize = 16)
+def _get_decoder(encoding):
+    return codecs.getdecoder(encoding)
+
+def _communicate_posix(proc):
+    """Equivalent to ``proc.communicate()`` (with no input), but reads the pipes with
+    ``os.read`` in a selector loop instead of spawning the stdlib's per-stream reader
+    threads, accumulating into bytearrays to avoid the list-of-chunks rebuild"""
+    from selectors import DefaultSelector, EVENT_READ
+    if proc.stdin is not None:
+        proc.stdin.close()
+    bufs = {}
+    sel = DefaultSelector()
+    try:
+        for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+            if stream is not None:
+                bufs[name] = bytearray()
+                sel.register(stream, EVENT_READ, name)
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, 65536)
+                if data:
+                    bufs[key.data] += data
+                else:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+    finally:
+        sel.close()
+    proc.wait()
+    return (bytes(bufs["stdout"]) if "stdout" in bufs else None,
+        bytes(bufs["stderr"]) if "stderr" in bufs else None)
+
 def run_proc(proc, retcode, timeout = None):
     """Waits for the given process to terminate, with the expected exit code
 
@@ -231,13 +511,23 @@ def run_proc(proc, retcode, timeout = None):
     :returns: A tuple of (return code, stdout, stderr)
     """
     _register_proc_timeout(proc, timeout)
-    stdout, stderr = proc.communicate()
+    if IS_WIN32 or not isinstance(proc, Popen) or getattr(proc, "text_mode", False):
+        stdout, stderr = proc.communicate()
+    else:
+        stdout, stderr = _communicate_posix(proc)
     proc._end_time = time.time()
     if not stdout:
         stdout = six.b("")
     if not stderr:
         stderr = six.b("")
-    if hasattr(proc, "_decode"):
+    encoding = getattr(proc, "encoding", None)
+    if encoding:
+        # the cached C-level decoder with a constant errors argument hits
+        # CPython's fast path; proc._decode would add a Python frame per call
+        dec = _get_decoder(encoding)
+        stdout = dec(stdout, "ignore")[0]
+        stderr = dec(stderr, "ignore")[0]
+    elif hasattr(proc, "_decode"):
         stdout = proc._decode(stdout)
         stderr = proc._decode(stderr)
 
@@ -267,22 +557,37 @@ def iter_lines(proc, retcode = 0, timeout = None, linesize = -1, _iter_lines = _
     :returns: An iterator of (out, err) line tuples.
     """
 
-    if hasattr(proc, "_decode"):
+    encoding = getattr(proc, "encoding", None)
+    if encoding:
+        # bind the C-level decoder once instead of paying a Python method call
+        # plus two attribute lookups (proc._decode, .rstrip) for every line
+        _dec = codecs.getdecoder(encoding)
+        decode = lambda s, _dec = _dec: _dec(s, "ignore")[0].rstrip()
+    elif hasattr(proc, "_decode"):
         decode = lambda s: proc._decode(s).rstrip()
     else:
         decode = lambda s: s
 
     _register_proc_timeout(proc, timeout)
 
-    buffers = [[], []]
+    # keep the first 10 and the last 90 lines of each stream -- the same
+    # 100-line memory bound as before, still O(1) per append, but diagnostics
+    # retain how the output started as well as how it ended
+    heads = [[], []]
+    tails = [deque(maxlen = 90), deque(maxlen = 90)]
+    counts = [0, 0]
     for t, line in _iter_lines(proc, decode, linesize, line_timeout):
         ret = [None, None]
         ret[t] = line
-        buffers[t].append(line)
-        if len(buffers[t]) > 100:
-            buffers[t][:2] = ["<...previous lines omitted...>"]
+        counts[t] += 1
+        if counts[t] <= 10:
+            heads[t].append(line)
+        else:
+            tails[t].append(line)
         yield ret
 
     # this will take care of checking return code and timeouts
-    proc.stdout, proc.stderr = ("\n".join(s) for s in buffers)
+    proc.stdout, proc.stderr = (
+        "\n".join(heads[t] + (["<...%d lines omitted...>" % (counts[t] - 100,)] if counts[t] > 100 else []) + list(tails[t]))
+        for t in (0, 1))
     _check_process(proc, retcode, timeout, proc.stdout, proc.stderr)
@@ -28,12 +28,15 @@ class EnvPathList(list):
 
 class BaseEnv(object):
     """The base class of LocalEnv and RemoteEnv"""
-    __slots__ = ["_curr", "_path", "_path_factory"]
+    __slots__ = ["_curr", "_path", "_path_factory", "_version"]
     CASE_SENSITIVE = True
 
     def __init__(self, path_factory, pathsep):
         self._path_factory = path_factory
         self._path = EnvPathList(path_factory, pathsep)
+        # bumped on every mutation, so callers can cache derived state
+        # (e.g. a formatted env prefix) and cheaply tell when it went stale
+        self._version = 0
         self._update_path()
 
     def _update_path(self):
@@ -54,6 +57,7 @@ class BaseEnv(object):
             yield
         finally:
             self._curr = prev
+            self._version += 1
             self._update_path()
 
     def __iter__(self):
@@ -89,28 +93,33 @@ class BaseEnv(object):
         """Deletes an environment variable from the current environment"""
         name = name if self.CASE_SENSITIVE else name.upper()
         del self._curr[name]
+        self._version += 1
         if name == "PATH":
             self._update_path()
     def __setitem__(self, name, value):
         """Sets/replaces an environment variable's value in the current environment"""
         name = name if self.CASE_SENSITIVE else name.upper()
         self._curr[name] = value
+        self._version += 1
         if name == "PATH":
             self._update_path()
     def pop(self, name, *default):
         """Pops an element from the current environment (like dict.pop)"""
         name = name if self.CASE_SENSITIVE else name.upper()
         res = self._curr.pop(name, *default)
+        self._version += 1
         if name == "PATH":
             self._update_path()
         return res
     def clear(self):
         """Clears the current environment (like dict.clear)"""
         self._curr.clear()
+        self._version += 1
         self._update_path()
     def update(self, *args, **kwargs):
         """Updates the current environment (like dict.update)"""
         self._curr.update(*args, **kwargs)
+        self._version += 1
         if not self.CASE_SENSITIVE:
             for k, v in list(self._curr.items()):
                 self._curr[k.upper()] = v
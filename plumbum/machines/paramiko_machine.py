@@ -1,13 +1,19 @@
 import logging
 import errno
+import hashlib
+import os
 import socket
+import stat
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from selectors import DefaultSelector, EVENT_READ
 from plumbum.machines.remote import BaseRemoteMachine
 from plumbum.machines.session import ShellSession
 from plumbum.lib import _setdoc, six
 from plumbum.path.local import LocalPath
 from plumbum.commands.processes import iter_lines, ProcessLineTimedOut
-from plumbum.path.remote import RemotePath
+from plumbum.path.remote import RemotePath, StatRes
 try:
     # Sigh... we need to gracefully-import paramiko for Sphinx builds, etc
     import paramiko
@@ -23,6 +29,115 @@ except ImportError:
 
 logger = logging.getLogger("plumbum.paramiko")
 
+# number of concurrent SFTP sessions used for recursive uploads/downloads
+_SFTP_TRANSFER_WORKERS = 4
+
+# flow-control tuning for SFTP channels: a large window keeps the pipe full on
+# high-bandwidth/high-latency links, while exec channels keep paramiko's
+# defaults (we don't want command output buffered that aggressively)
+_SFTP_WINDOW_SIZE = 2 ** 27
+_SFTP_MAX_PACKET_SIZE = 32768
+
+# maps S_IFMT(st_mode) to the wording GNU stat's %F uses, which is what
+# RemotePath.is_dir()/is_file()/is_symlink() dispatch on
+_stat_text_modes = {
+    stat.S_IFDIR: "directory",
+    stat.S_IFREG: "regular file",
+    stat.S_IFLNK: "symbolic link",
+    stat.S_IFBLK: "block special file",
+    stat.S_IFCHR: "character special file",
+    stat.S_IFIFO: "fifo",
+    stat.S_IFSOCK: "socket",
+}
+
+# ControlPersist-style cache of idle SSH connections: close() parks the
+# connected client here instead of tearing it down, and a new ParamikoMachine
+# for the same (host, user, port, keyfile) picks it up, skipping the TCP+SSH
+# handshake. Idle connections are evicted after _CONNECTION_CACHE_TTL seconds.
+_CONNECTION_CACHE_TTL = 600
+_connection_cache = {}      # cache key -> (SSHClient, expiry timestamp)
+_connection_cache_lock = threading.Lock()
+_eviction_timer_armed = False  # protected by _connection_cache_lock
+
+def _schedule_eviction():
+    # at most one eviction timer is outstanding at any time (the same
+    # scheme _signal_timeout_thread uses for its wakeups) -- a service
+    # cycling machines must not pile up one sleeping thread per close().
+    # The sweep re-arms itself while the cache holds entries, so an entry
+    # parked just after a sweep fires can live up to 2*TTL; that's fine.
+    # Must be called with _connection_cache_lock held
+    global _eviction_timer_armed
+    if _eviction_timer_armed:
+        return
+    _eviction_timer_armed = True
+    timer = threading.Timer(_CONNECTION_CACHE_TTL, _evict_expired_clients)
+    timer.daemon = True
+    timer.start()
+
+def _park_cached_client(key, client):
+    evicted = None
+    with _connection_cache_lock:
+        if key in _connection_cache:
+            evicted = _connection_cache.pop(key)[0]
+        _connection_cache[key] = (client, time.monotonic() + _CONNECTION_CACHE_TTL)
+        _schedule_eviction()
+    if evicted is not None:
+        evicted.close()
+
+def _checkout_cached_client(key):
+    with _connection_cache_lock:
+        entry = _connection_cache.pop(key, None)
+    if entry is None:
+        return None
+    client, expiry = entry
+    if expiry <= time.monotonic():
+        client.close()
+        return None
+    return client
+
+def _evict_expired_clients():
+    global _eviction_timer_armed
+    now = time.monotonic()
+    expired = []
+    with _connection_cache_lock:
+        _eviction_timer_armed = False
+        for key, (client, expiry) in list(_connection_cache.items()):
+            if expiry <= now:
+                del _connection_cache[key]
+                expired.append(client)
+        if _connection_cache:
+            _schedule_eviction()
+    for client in expired:
+        client.close()
+
+class _BatchedWriter(object):
+    """Wraps an output file, accumulating writes and passing them on when the
+    buffer reaches ``max_bytes`` or ``max_interval`` seconds have passed since
+    the last flush -- instead of a write+flush syscall pair per chunk"""
+    def __init__(self, outfile, max_bytes = 65536, max_interval = 0.1):
+        self.outfile = outfile
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self._chunks = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if (self._size >= self.max_bytes
+                or time.monotonic() - self._last_flush >= self.max_interval):
+            self.flush()
+    def flush(self):
+        if self._chunks:
+            outfile = self.outfile
+            for chunk in self._chunks:
+                outfile.write(chunk)
+            del self._chunks[:]
+            self._size = 0
+        self.outfile.flush()
+        self._last_flush = time.monotonic()
+
+
 class ParamikoPopen(object):
     def __init__(self, argv, stdin, stdout, stderr, encoding, machine, stdin_file = None,
             stdout_file = None, stderr_file = None):
@@ -66,41 +181,89 @@ class ParamikoPopen(object):
             raise NotImplementedError()
         return self.machine.cmd.kill("-%s" % sig, self.pid)
     def communicate(self):
-        stdout = []
-        stderr = []
+        if self.stdin_file is None and self.stdout_file is None and self.stderr_file is None:
+            return self._communicate_fast()
+        # stdout and stderr are multiplexed over the one channel, so a single
+        # selector registration covers both; this avoids the old round-robin
+        # scheme that blocked on whichever stream happened to be next, even
+        # when all the output was arriving on the other one
+        collected = [bytearray(), bytearray()]
+        outfiles = tuple(_BatchedWriter(f) if f is not None else None
+            for f in (self.stdout_file, self.stderr_file))
         infile = self.stdin_file
-        sources = [("1", stdout, self.stdout, self.stdout_file), ("2", stderr, self.stderr, self.stderr_file)]
-        i = 0
-        while sources:
-            if infile:
-                try:
-                    line = infile.readline()
-                except (ValueError, IOError):
-                    line = None
-                logger.debug("communicate: %r", line)
-                if not line:
-                    infile.close()
-                    infile = None
-                    self.stdin.close()
-                else:
-                    self.stdin.write(line)
-                    self.stdin.flush()
-
-            i = (i + 1) % len(sources)
-            name, coll, pipe, outfile = sources[i]
-            line = pipe.readline()
-            # logger.debug("%s> %r", name, line)
-            if not line:
-                del sources[i]
-            elif outfile:
-                outfile.write(line)
+        chan = self.channel
+        sel = DefaultSelector()
+        sel.register(chan, EVENT_READ)
+        try:
+            while True:
+                # the channel's fileno only signals incoming data, so stdin is
+                # interleaved opportunistically: feed as much as the window
+                # allows per iteration, or a sink command that produces no
+                # output would be throttled to one line per select timeout
+                while infile and chan.send_ready():
+                    try:
+                        line = infile.readline()
+                    except (ValueError, IOError):
+                        line = None
+                    logger.debug("communicate: %r", line)
+                    if not line:
+                        infile.close()
+                        infile = None
+                        self.stdin.close()
+                    else:
+                        self.stdin.write(line)
+                        self.stdin.flush()
+
+                sel.select(0.1 if infile else None)
+                for tag, ready, recv in ((0, chan.recv_ready, chan.recv),
+                        (1, chan.recv_stderr_ready, chan.recv_stderr)):
+                    while ready():
+                        data = recv(65536)
+                        if not data:
+                            break
+                        outfile = outfiles[tag]
+                        if outfile:
+                            outfile.write(data)
+                        else:
+                            collected[tag] += data
+                if ((chan.eof_received or chan.closed)
+                        and not chan.recv_ready() and not chan.recv_stderr_ready()):
+                    break
+        finally:
+            sel.close()
+        if infile is not None:
+            # the remote side EOF'd before consuming all its input
+            infile.close()
+            self.stdin.close()
+        for outfile in outfiles:
+            if outfile:
                 outfile.flush()
-            else:
-                coll.append(line)
         self.wait()
-        stdout = six.b("").join(six.b(s) for s in stdout)
-        stderr = six.b("").join(six.b(s) for s in stderr)
-        return stdout, stderr
+        return bytes(collected[0]), bytes(collected[1])
+
+    def _communicate_fast(self):
+        # the overwhelmingly common case -- no stdin to feed and no output
+        # redirections -- reduced to a bare drain loop with no per-iteration
+        # stdin/outfile branches
+        out = bytearray()
+        err = bytearray()
+        chan = self.channel
+        sel = DefaultSelector()
+        sel.register(chan, EVENT_READ)
+        try:
+            while True:
+                sel.select()
+                while chan.recv_ready():
+                    out += chan.recv(65536)
+                while chan.recv_stderr_ready():
+                    err += chan.recv_stderr(65536)
+                if ((chan.eof_received or chan.closed)
+                        and not chan.recv_ready() and not chan.recv_stderr_ready()):
+                    break
+        finally:
+            sel.close()
+        self.wait()
+        return bytes(out), bytes(err)
 
     def _decode(self, bytes):
         return bytes.decode(self.encoding, "ignore")
@@ -207,11 +370,22 @@ class ParamikoMachine(BaseRemoteMachine):
             kwargs["timeout"] = connect_timeout
         self._connect_params = kwargs
         self._make_socket = make_socket
+        # the cache key must cover everything that affects authentication and
+        # host-key verification, or two differently-configured machines for
+        # the same host would hand each other their connections; the password
+        # is hashed so the key never holds it in the clear
+        self._cache_key = (host, user, port, str(keyfile),
+            hashlib.sha1(password.encode("utf8")).hexdigest() if password else None,
+            pkey.get_fingerprint() if pkey is not None else None,
+            look_for_keys, load_system_host_keys,
+            type(missing_host_policy).__name__ if missing_host_policy is not None else None)
         self._connection_lock = threading.RLock()
         self._connected = False
         self._keep_alive = keep_alive
         self._sftp = None
-        self._client  # make it connect
+        self._transport = None
+        self._prefix_cache = None
+        self._rtt_hint = 0.0
         BaseRemoteMachine.__init__(self, encoding, connect_timeout)
 
     @property
@@ -219,23 +393,57 @@ class ParamikoMachine(BaseRemoteMachine):
         if not self._connected:
             with self._connection_lock:
                 if not self._connected:
-                    self._paramiko_client.connect(sock=self._make_socket(), **self._connect_params)
+                    cached = _checkout_cached_client(self._cache_key)
+                    if cached is not None and cached.get_transport() is not None \
+                            and cached.get_transport().is_active():
+                        self._paramiko_client = cached
+                    else:
+                        self._paramiko_client.connect(sock=self._make_socket(), **self._connect_params)
+                    self._transport = self._paramiko_client.get_transport()
+                    self._transport.set_keepalive(self._keep_alive)
+                    # one extra round trip to estimate the link latency; used
+                    # to pad line timeouts so a slow link doesn't turn into
+                    # spurious ProcessLineTimedOut errors
+                    try:
+                        started = time.monotonic()
+                        self._transport.global_request("keepalive@openssh.com", wait = True)
+                        self._rtt_hint = time.monotonic() - started
+                    except Exception:
+                        pass  # the reply is all we wanted; keep the default hint
                 self._connected = True
         return self._paramiko_client
 
+    def connect(self):
+        """Re-establishes the SSH connection if it is not currently open.
+        Construction already connects (the machine opens its shell session up
+        front), so this is only needed to come back after an explicit
+        :func:`disconnect` or a dropped transport"""
+        self._client
+
     def disconnect(self):
         with self._connection_lock:
             self._paramiko_client.close()
         self._connected = False
         self._sftp = None
+        self._transport = None
 
     def __str__(self):
         return "paramiko://%s" % (self._fqhost,)
 
     def close(self):
+        # an active connection is parked in the module-level cache rather than
+        # torn down, so the next machine for the same host reuses it; call
+        # disconnect() to actually sever the connection
         BaseRemoteMachine.close(self)
         if self._connected:
-            self.disconnect()
+            if (_CONNECTION_CACHE_TTL > 0 and self._transport is not None
+                    and self._transport.is_active()):
+                _park_cached_client(self._cache_key, self._paramiko_client)
+                self._connected = False
+                self._sftp = None
+                self._transport = None
+            else:
+                self.disconnect()
 
     @property
     def sftp(self):
@@ -243,46 +451,102 @@ class ParamikoMachine(BaseRemoteMachine):
         Returns an SFTP client on top of the current SSH connection; it can be used to manipulate
         files directly, much like an interactive FTP/SFTP session
         """
-        if not self._sftp or not self._connected:
-            self._sftp = self._client.open_sftp()
+        if not self._sftp or not self._connected or not self._transport.active:
+            self._sftp = self._open_sftp()
         return self._sftp
 
+    def _open_sftp(self):
+        self._client  # make sure we are connected
+        return paramiko.SFTPClient.from_transport(self._transport,
+            window_size = _SFTP_WINDOW_SIZE, max_packet_size = _SFTP_MAX_PACKET_SIZE)
+
     @_setdoc(BaseRemoteMachine)
     def session(self, isatty = False, term = "vt100", width = 80, height = 24, new_session = False):
         # new_session is ignored for ParamikoMachine
-        trans = self._client.get_transport()
-        trans.set_keepalive(self._keep_alive)
-        chan = trans.open_session()
+        self._client  # make sure we are connected
+        chan = self._transport.open_session()
         if isatty:
             chan.get_pty(term, width, height)
             chan.set_combine_stderr()
         chan.invoke_shell()
+        # block-buffer the read side; shell sessions interleave readline (for
+        # marker detection) with bulk reads, and a 64KB buffer serves both.
+        # stdin stays line-buffered -- session commands are whole lines anyway
         stdin = chan.makefile('wb', -1)
-        stdout = chan.makefile('rb', -1)
-        stderr = chan.makefile_stderr('rb', -1)
+        stdout = chan.makefile('rb', 65536)
+        stderr = chan.makefile_stderr('rb', 65536)
         proc = ParamikoPopen(["<shell>"], stdin, stdout, stderr, self.encoding, self)
         return ShellSession(proc, self.encoding, isatty)
 
-    @_setdoc(BaseRemoteMachine)
-    def popen(self, args, stdin = None, stdout = None, stderr = None, new_session = False, cwd = None):
-        # new_session is ignored for ParamikoMachine
-        argv = []
-        envdelta = self.env.getdelta()
-        argv.extend(["cd", str(cwd or self.cwd), "&&"])
-        if envdelta:
-            argv.append("env")
-            argv.extend("%s=%s" % (k, v) for k, v in envdelta.items())
+    def _build_argv(self, args, cwd):
+        # the cd/env prefix only changes when the environment or the working
+        # directory does, so it is cached keyed on the env's mutation counter
+        # plus PATH (which can be mutated in-place, bypassing the counter)
+        key = (self.env._version, self.env.path.join(), str(cwd or self.cwd))
+        cached = self._prefix_cache
+        if cached is not None and cached[0] == key:
+            argv = list(cached[1])
+        else:
+            argv = ["cd", key[2], "&&"]
+            envdelta = self.env.getdelta()
+            if envdelta:
+                argv.append("env")
+                argv.extend(["%s=%s" % (k, v) for k, v in envdelta.items()])
+            self._prefix_cache = (key, tuple(argv))
         args = args.formulate()
         if self._as_user_stack:
             args, executable = self._as_user_stack[-1](args)
         argv.extend(args)
+        return argv
+
+    @_setdoc(BaseRemoteMachine)
+    def popen(self, args, stdin = None, stdout = None, stderr = None, new_session = False,
+            cwd = None, combine_stderr = False):
+        # new_session is ignored for ParamikoMachine
+        argv = self._build_argv(args, cwd)
         cmdline = " ".join(argv)
         logger.debug(cmdline)
-        si, so, se = streams = self._client.exec_command(cmdline, 1)
+        if combine_stderr:
+            # a single merged stream: one recv buffer and half the selector
+            # traffic, for callers who don't need stderr separated
+            self._client  # make sure we are connected
+            chan = self._transport.open_session()
+            chan.set_combine_stderr(True)
+            chan.exec_command(cmdline)
+            si = chan.makefile('wb', 65536)
+            so = chan.makefile('rb', 65536)
+            se = None
+        else:
+            si, so, se = self._client.exec_command(cmdline, 65536)
         proc = ParamikoPopen(argv, si, so, se, self.encoding, self, stdin_file = stdin,
             stdout_file = stdout, stderr_file = stderr)
         return proc
 
+    def popen_many(self, arg_list, cwd = None):
+        """Starts several commands concurrently, each on its own channel of the
+        shared SSH transport, and returns a list of :class:`ParamikoPopen` objects
+        (in the order of ``arg_list``). The per-channel open round trips are
+        issued over a small thread pool, so several commands start in roughly
+        the time ``popen`` needs for one; their outputs can be consumed
+        together with :func:`iter_all_lines`"""
+        self._client  # make sure we are connected
+        argvs = [self._build_argv(args, cwd) for args in arg_list]
+        def start(argv):
+            cmdline = " ".join(argv)
+            logger.debug(cmdline)
+            chan = self._transport.open_session()
+            chan.exec_command(cmdline)
+            si = chan.makefile('wb', 65536)
+            so = chan.makefile('rb', 65536)
+            se = chan.makefile_stderr('rb', 65536)
+            return ParamikoPopen(argv, si, so, se, self.encoding, self)
+        if len(argvs) <= 1:
+            return [start(argv) for argv in argvs]
+        # paramiko's Transport is thread-safe, so the open_session round trips
+        # can be overlapped the same way _transfer_files overlaps SFTP ops
+        with ThreadPoolExecutor(min(len(argvs), _SFTP_TRANSFER_WORKERS)) as pool:
+            return list(pool.map(start, argvs))
+
     @_setdoc(BaseRemoteMachine)
     def download(self, src, dst):
         if isinstance(src, LocalPath):
@@ -296,15 +560,64 @@ class ParamikoMachine(BaseRemoteMachine):
 
     def _download(self, src, dst):
         if src.is_dir():
-            if not dst.exists():
-                self.sftp.mkdir(str(dst))
-            for fn in src:
-                self._download(fn, dst / fn.name)
+            pairs = []
+            self._collect_downloads(src, dst, pairs)
+            self._transfer_files("get", pairs)
         elif dst.is_dir():
             self.sftp.get(str(src), str(dst / src.name))
         else:
             self.sftp.get(str(src), str(dst))
 
+    def _collect_downloads(self, src, dst, pairs):
+        # a single listdir_attr returns the mode bits of every entry in one
+        # round trip, instead of a listdir plus an SFTP stat per entry
+        if not dst.exists():
+            self.sftp.mkdir(str(dst))
+        for attr in self.sftp.listdir_attr(str(src)):
+            if stat.S_ISDIR(attr.st_mode):
+                self._collect_downloads(src / attr.filename, dst / attr.filename, pairs)
+            else:
+                pairs.append((str(src / attr.filename), str(dst / attr.filename)))
+
+    def _collect_uploads(self, src, dst, pairs):
+        # scandir yields the entry type without a stat syscall per entry
+        if not dst.exists():
+            self.sftp.mkdir(str(dst))
+        with os.scandir(str(src)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self._collect_uploads(src / entry.name, dst / entry.name, pairs)
+                else:
+                    pairs.append((entry.path, str(dst / entry.name)))
+
+    def _transfer_files(self, op, pairs):
+        """Runs ``sftp.get``/``sftp.put`` over the given (src, dst) pairs, with
+        several transfers in flight at once so round-trip latency is overlapped
+        rather than paid serially per file"""
+        if len(pairs) <= 1:
+            for src, dst in pairs:
+                getattr(self.sftp, op)(src, dst)
+            return
+        # paramiko SFTP clients are not thread-safe, so each worker opens its
+        # own SFTP session on the shared transport
+        tls = threading.local()
+        clients = []
+        clients_lock = threading.Lock()
+        def transfer(pair):
+            sftp = getattr(tls, "sftp", None)
+            if sftp is None:
+                sftp = tls.sftp = self._open_sftp()
+                with clients_lock:
+                    clients.append(sftp)
+            getattr(sftp, op)(*pair)
+        try:
+            with ThreadPoolExecutor(min(len(pairs), _SFTP_TRANSFER_WORKERS)) as pool:
+                for _ in pool.map(transfer, pairs):
+                    pass
+        finally:
+            for sftp in clients:
+                sftp.close()
+
     @_setdoc(BaseRemoteMachine)
     def upload(self, src, dst):
         if isinstance(src, RemotePath):
@@ -318,10 +631,9 @@ class ParamikoMachine(BaseRemoteMachine):
 
     def _upload(self, src, dst):
         if src.is_dir():
-            if not dst.exists():
-                self.sftp.mkdir(str(dst))
-            for fn in src:
-                self._upload(fn, dst / fn.name)
+            pairs = []
+            self._collect_uploads(src, dst, pairs)
+            self._transfer_files("put", pairs)
         elif dst.is_dir():
             self.sftp.put(str(src), str(dst / src.name))
         else:
@@ -341,9 +653,8 @@ class ParamikoMachine(BaseRemoteMachine):
         if ipv6 and dhost == "localhost":
             dhost = "::1"
         srcaddr = ("::1", 0, 0, 0) if ipv6 else ("127.0.0.1", 0)
-        trans = self._client.get_transport()
-        trans.set_keepalive(self._keep_alive)
-        chan = trans.open_channel('direct-tcpip', (dhost, dport), srcaddr)
+        self._client  # make sure we are connected
+        chan = self._transport.open_channel('direct-tcpip', (dhost, dport), srcaddr)
         return SocketCompatibleChannel(chan)
 
     #
@@ -352,6 +663,24 @@ class ParamikoMachine(BaseRemoteMachine):
     def _path_listdir(self, fn):
         return self.sftp.listdir(str(fn))
 
+    def _path_stat(self, fn):
+        # one SFTP lstat round trip, instead of the base class' shell `stat`
+        # run through the session marker protocol. lstat matches the shell
+        # version's symlink semantics (is_symlink relies on it)
+        try:
+            st = self.sftp.lstat(str(fn))
+        except IOError:
+            return None
+        mode = st.st_mode
+        res = StatRes((mode, 0, 0, 0, st.st_uid, st.st_gid,
+            st.st_size or 0, st.st_atime, st.st_mtime, st.st_mtime))
+        fmt = stat.S_IFMT(mode)
+        if fmt == stat.S_IFREG and not st.st_size:
+            res.text_mode = "regular empty file"
+        else:
+            res.text_mode = _stat_text_modes.get(fmt, "unknown")
+        return res
+
     def _path_read(self, fn):
         f = self.sftp.open(str(fn), 'rb')
         data = f.read()
@@ -373,57 +702,150 @@ class ParamikoMachine(BaseRemoteMachine):
 class SocketCompatibleChannel(object):
     def __init__(self, chan):
         self._chan = chan
+        # pre-bind the common passthrough methods as instance attributes, so
+        # hot loops don't pay the __getattr__ fallback on every call
+        self.close = chan.close
+        self.fileno = chan.fileno
+        self.settimeout = chan.settimeout
+        self.setblocking = chan.setblocking
     def __getattr__(self, name):
         return getattr(self._chan, name)
     def send(self, s):
         if self._chan.closed:
             raise socket.error(errno.EBADF, 'Bad file descriptor')
         return self._chan.send(s)
+    def sendall(self, s):
+        if self._chan.closed:
+            raise socket.error(errno.EBADF, 'Bad file descriptor')
+        view = memoryview(s)
+        while view:
+            view = view[self._chan.send(view):]
     def recv(self, count):
         if self._chan.closed:
             raise socket.error(errno.EBADF, 'Bad file descriptor')
         return self._chan.recv(count)
+    def recv_into(self, buf, nbytes = 0):
+        # paramiko channels have no recv_into of their own
+        if self._chan.closed:
+            raise socket.error(errno.EBADF, 'Bad file descriptor')
+        data = self._chan.recv(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
 
 
 ###################################################################################################
 # Custom iter_lines for paramiko.Channel
 ###################################################################################################
-def _iter_lines(proc, decode, linesize, line_timeout=None):
+def iter_all_lines(procs):
+    """Aggregates the output of several :class:`ParamikoPopen` objects (e.g. as
+    returned by :func:`ParamikoMachine.popen_many
+    <plumbum.machines.paramiko_machine.ParamikoMachine.popen_many>`), watching all
+    their channels with a single selector and yielding ``(proc_index, stream_tag,
+    line)`` tuples as lines arrive; ``stream_tag`` is 0 for stdout, 1 for stderr.
+    Like :func:`iter_lines <plumbum.commands.processes.iter_lines>`, lines are
+    yielded with the trailing newline stripped"""
+    sel = DefaultSelector()
+    bufs = [[bytearray(), bytearray()] for _ in procs]
+    for index, proc in enumerate(procs):
+        sel.register(proc.stdout.channel, EVENT_READ, index)
+
+    def emit(index):
+        for tag in (0, 1):
+            buf = bufs[index][tag]
+            idx = buf.find(b"\n")
+            while idx >= 0:
+                line = bytes(buf[:idx])
+                del buf[:idx + 1]
+                yield index, tag, procs[index]._decode(line).rstrip()
+                idx = buf.find(b"\n")
 
     try:
-        from selectors import DefaultSelector, EVENT_READ
-    except ImportError:
-        # Pre Python 3.4 implementation
-        from select import select
+        pending = len(procs)
+        while pending:
+            for key, mask in sel.select():
+                index = key.data
+                chan = key.fileobj
+                while chan.recv_ready():
+                    bufs[index][0] += chan.recv(65536)
+                while chan.recv_stderr_ready():
+                    bufs[index][1] += chan.recv_stderr(65536)
+                for item in emit(index):
+                    yield item
+                if ((chan.eof_received or chan.closed)
+                        and not chan.recv_ready() and not chan.recv_stderr_ready()):
+                    sel.unregister(chan)
+                    pending -= 1
+                    procs[index].wait()
+                    for tag in (0, 1):
+                        if bufs[index][tag]:
+                            trailing = bytes(bufs[index][tag])
+                            del bufs[index][tag][:]
+                            yield index, tag, procs[index]._decode(trailing).rstrip()
+    finally:
+        sel.close()
 
-        def selector():
-            while True:
-                rlist, _, _ = select([proc.stdout.channel], [], [], line_timeout)
-                if not rlist and line_timeout:
-                    raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
-                for _ in rlist:
-                    yield
+
+def _iter_lines(proc, decode, linesize, line_timeout=None):
+    chan = proc.stdout.channel
+    sel = DefaultSelector()
+    sel.register(chan, EVENT_READ)
+    bufs = [bytearray(), bytearray()]
+    if line_timeout:
+        # pad the select timeout with twice the measured link round-trip
+        # time, so the latency budget belongs to the remote command rather
+        # than the network
+        rtt = getattr(getattr(proc, "machine", None), "_rtt_hint", 0) or 0
+        select_timeout = line_timeout + 2 * rtt
     else:
-        # Python 3.4 implementation
-        def selector():
-            sel = DefaultSelector()
-            sel.register(proc.stdout.channel, EVENT_READ)
-            while True:
-                ready = sel.select(line_timeout)
-                if not ready and line_timeout:
-                    raise ProcessLineTimedOut("popen line timeout expired", getattr(proc, "argv", None), getattr(proc, "machine", None))
-                for key, mask in ready:
-                    yield
-
-    for _ in selector():
-        if proc.stdout.channel.recv_ready():
-            yield 0, decode(six.b(proc.stdout.readline(linesize)))
-        if proc.stdout.channel.recv_stderr_ready():
-            yield 1, decode(six.b(proc.stderr.readline(linesize)))
-        if proc.poll() is not None:
-            break
-
-    for line in proc.stdout:
-        yield 0, decode(six.b(line))
-    for line in proc.stderr:
-        yield 1, decode(six.b(line))
+        select_timeout = line_timeout
+
+    def emit(tag):
+        # yield every complete line buffered so far, slicing overlong ones
+        # into linesize chunks like the subprocess implementation does
+        buf = bufs[tag]
+        idx = buf.find(b"\n")
+        while idx >= 0:
+            line = bytes(buf[:idx])
+            del buf[:idx + 1]
+            if linesize > 0:
+                while len(line) > linesize:
+                    yield tag, decode(line[:linesize])
+                    line = line[linesize:]
+            yield tag, decode(line + b"\n")
+            idx = buf.find(b"\n")
+
+    try:
+        while True:
+            ready = sel.select(select_timeout)
+            if not ready and line_timeout:
+                raise ProcessLineTimedOut("popen line timeout expired",
+                    getattr(proc, "argv", None), getattr(proc, "machine", None))
+            # drain everything the transport has buffered before going back
+            # to the selector, instead of one readline per wakeup
+            while chan.recv_ready():
+                bufs[0] += chan.recv(65536)
+            while chan.recv_stderr_ready():
+                bufs[1] += chan.recv_stderr(65536)
+            for item in emit(0):
+                yield item
+            for item in emit(1):
+                yield item
+            if proc.poll() is not None:
+                break
+    finally:
+        sel.close()
+
+    for tag, pipe in ((0, proc.stdout), (1, proc.stderr)):
+        if pipe is None:  # stderr is combined into stdout
+            continue
+        rest = pipe.read()
+        if rest:
+            bufs[tag] += rest
+        for item in emit(tag):
+            yield item
+        if bufs[tag]:
+            # clear the shared buffer before yielding, in case the caller
+            # abandons the generator at this point
+            trailing = bytes(bufs[tag])
+            del bufs[tag][:]
+            yield tag, decode(trailing)
@@ -13,4 +13,19 @@ mgrep=m["grep"]
 
 (ls | mgrep["\\."])()
 
+# several commands on one transport, outputs multiplexed
+from plumbum.machines.paramiko_machine import iter_all_lines
+procs = m.popen_many([mls["-l"], m["uname"]["-a"], m["date"]])
+for index, tag, line in iter_all_lines(procs):
+    print(index, tag, line)
+
+# merged stdout+stderr on a single channel
+p = m.popen(mls["/no/such/dir"], combine_stderr = True)
+print(p.communicate())
+
+# reconnect after an explicit disconnect
+m.disconnect()
+m.connect()
+print(m["echo"]("back"))
+
 
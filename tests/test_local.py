@@ -612,6 +612,71 @@ for _ in range(%s):
     def test_cmd(self):
         local.cmd.ls("/tmp")
 
+
+class ProcessHelpersTest(unittest.TestCase):
+    def test_iter_lines_head_tail_summary(self):
+        import subprocess
+        from plumbum.commands.processes import iter_lines
+        p = subprocess.Popen([sys.executable, "-u", "-c",
+            "for i in range(300): print(i)"],
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        p.encoding = "utf-8"
+        lines = [out for out, err in iter_lines(p) if out is not None]
+        self.assertEqual(lines, [str(i) for i in range(300)])
+        # the summary keeps the first 10 and last 90 lines with an omission marker
+        expected = "\n".join([str(i) for i in range(10)]
+            + ["<...200 lines omitted...>"]
+            + [str(i) for i in range(210, 300)])
+        self.assertEqual(p.stdout, expected)
+        self.assertEqual(p.stderr, "")
+
+    def test_iter_lines_no_marker_under_100_lines(self):
+        import subprocess
+        from plumbum.commands.processes import iter_lines
+        p = subprocess.Popen([sys.executable, "-u", "-c",
+            "for i in range(5): print(i)"],
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        p.encoding = "utf-8"
+        list(iter_lines(p))
+        self.assertEqual(p.stdout, "\n".join(str(i) for i in range(5)))
+
+    def test_timeout_thread_starts_lazily(self):
+        # run in a fresh interpreter; this process may have started the
+        # timeout thread already
+        import subprocess
+        script = """if True:
+            import subprocess, sys
+            from plumbum.commands import processes
+            assert not processes._bgthd_started
+            processes._register_proc_timeout(None, None)
+            assert not processes._bgthd_started
+            p = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+            processes._register_proc_timeout(p, 5)
+            assert processes._bgthd_started
+            p.kill()
+            p.wait()
+            """
+        rc = subprocess.call([sys.executable, "-c", script])
+        self.assertEqual(rc, 0)
+
+    def test_shquote(self):
+        from plumbum.commands import shquote
+        # strings of safe characters pass through unquoted
+        self.assertEqual(shquote("safe/file.txt"), "safe/file.txt")
+        self.assertEqual(shquote("a-b_c.d:e,f=g"), "a-b_c.d:e,f=g")
+        self.assertEqual(shquote(""), "''")
+        self.assertEqual(shquote("hello world"), "'hello world'")
+        self.assertEqual(shquote("don't"), '"don\'t"')
+
+    def test_process_execution_error_str_cached(self):
+        exc = ProcessExecutionError(["ls", "-l"], 2, "out1\nout2", "err", local)
+        self.assertTrue(exc._str is None)
+        s = str(exc)
+        self.assertTrue("Command line:" in s and "Exit code: 2" in s)
+        self.assertTrue("out1" in s and "err" in s)
+        self.assertTrue(str(exc) is s)
+
+
 if __name__ == "__main__":
     unittest.main()
 